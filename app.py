@@ -8,8 +8,16 @@ from flask_cors import CORS
 import os
 from datetime import datetime
 import json
+import logging
 from lesson_generator import LessonPlanGenerator
-import traceback
+
+# Quiet by default; set LOG_LEVEL=INFO (or DEBUG) to see generation progress
+log_level = os.getenv('LOG_LEVEL', 'WARNING').upper()
+known_level = isinstance(logging.getLevelName(log_level), int)
+logging.basicConfig(level=log_level if known_level else logging.WARNING)
+logger = logging.getLogger(__name__)
+if not known_level:
+    logger.warning("Unknown LOG_LEVEL %r, using WARNING", log_level)
 
 app = Flask(__name__)
 CORS(app)
@@ -94,11 +102,13 @@ def generate_lesson_plan():
             'digital_platform': data.get('digital_platform', ''),
             'gifted_talented': data.get('gifted_talented', False),
             'ppt_style': data.get('ppt_style', '7E Model'),
-            'value': data.get('value', '')
+            'value': data.get('value', ''),
+            # force_refresh is accepted as another name for no_cache
+            'no_cache': bool(data.get('no_cache') or data.get('force_refresh'))
         }
         
         # Generate lesson plan package
-        print(f"Generating lesson plan for: {lesson_data['topic']}")
+        logger.info("Generating lesson plan for: %s", lesson_data['topic'])
         result = generator.generate_complete_package(lesson_data)
         
         if result['status'] == 'success':
@@ -115,8 +125,7 @@ def generate_lesson_plan():
             }), 500
     
     except Exception as e:
-        print(f"Error in generate_lesson_plan: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error in generate_lesson_plan")
         return jsonify({
             'status': 'error',
             'message': f'Server error: {str(e)}'
@@ -5,78 +5,407 @@ Uses Google Gemini with correct model name
 
 import os
 import json
+import logging
+import multiprocessing
+import hashlib
+import random
+import threading
+import time
 from datetime import datetime
-from docx import Document
-from docx.shared import Inches, Pt, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
+from types import MappingProxyType
 import zipfile
-import google.generativeai as genai
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+try:
+    import orjson
+except ImportError:  # optional: faster JSON for Gemini responses and the cache
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+if orjson is not None:
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+
+    def _json_dumps_sorted(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+else:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        # Match orjson: compact separators and raw UTF-8 rather than \uXXXX escapes
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def _json_dumps_sorted(obj):
+        # Same bytes as orjson with OPT_SORT_KEYS, so cache keys do not change
+        return json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# Instructions shared by every lesson request, kept separate from the
+# per-lesson details and sent as the system instruction.
+LESSON_PROMPT_INSTRUCTIONS = """Create a detailed lesson plan for the lesson described under LESSON DETAILS.
+
+School: Al Adhwa Private School, UAE
+Periods: 1=Introduction, 2=Development, 3=Mastery
+
+Make it SPECIFIC with:
+1. 3-4 clear objectives using Bloom's verbs (analyze, evaluate, create)
+2. Differentiated activities for 3 ability levels
+3. UAE context and values integration
+4. SPECIFIC questions for each activity (not general)
+5. Real-world applications in UAE context
+
+Example format for objectives:
+"Students will be able to ANALYZE the relationship between variables through data collection."
+"Students will be able to EVALUATE different solutions by comparing effectiveness."
+
+Example for activities:
+"Group 1: Create a model showing X and answer: 1. What are the main components? 2. How do they interact? 3. What would happen if Y changed?"
+
+Be PRACTICAL for classroom use in UAE schools.
+
+Return the lesson plan as JSON following the response schema. Put each objective
+on its own line in "objectives", and give every activity its own specific questions."""
+
+# The only per-lesson part of the prompt, sent as the request contents.
+LESSON_PROMPT_DETAILS = """LESSON DETAILS:
+Grade: {grade}
+Subject: {subject}
+Topic: {topic}
+Period: {period}
+UAE Value: {value}"""
+
+
+# LESSON_PROMPT_INSTRUCTIONS goes out as the system instruction. At a few
+# hundred tokens it is below the minimum prompt size for Gemini context
+# caching (1024 tokens on 2.5 Flash), explicit or implicit, so it is not cached
+GEMINI_MODEL = 'gemini-2.5-flash'
+# Cheaper, faster model for introductory lessons. If its answer cannot be
+# parsed the request is retried on GEMINI_MODEL.
+GEMINI_LIGHT_MODEL = 'gemini-2.5-flash-lite'
+# Thinking tokens add cost and seconds of latency to every call, and filling
+# in a schema-shaped lesson plan does not need them, so thinking is off
+GEMINI_THINKING_BUDGET = 0
+
+# Retry budget for transient Gemini errors before falling back to templates
+GEMINI_MAX_ATTEMPTS = 4
+GEMINI_MAX_BACKOFF = 30  # seconds
+
+
+def _env_int(name, default):
+    """Integer setting from the environment, falling back to default if unset or invalid"""
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning("Ignoring non-integer %s=%r, using %d", name, value, default)
+        return default
+
+
+# Optional client-side limit on Gemini requests per minute, per model and per
+# gunicorn worker. Calls draw from a token bucket holding this many tokens
+# that refills over 60s, so bursts up to the limit go straight through and
+# only calls beyond it wait instead of being rejected with 429. Set it to
+# about 80% of the project's quota divided by the worker count (e.g. 8 for
+# one worker on the 10 RPM free tier). Waiting counts towards gunicorn's
+# worker timeout. 0 (the default) disables it.
+GEMINI_RPM_LIMIT = _env_int('GEMINI_RPM_LIMIT', 0)
+
+# Batch jobs (see generate_ai_content_batch) are polled until they reach one of these.
+# The SDK does not map the Gemini API's BATCH_STATE_EXPIRED, so it is listed as-is.
+GEMINI_BATCH_DONE_STATES = (
+    'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED',
+    'BATCH_STATE_EXPIRED'
+)
+GEMINI_BATCH_POLL_INTERVAL = 30  # seconds
+# Default wait for a batch job before cancelling it and using templates
+GEMINI_BATCH_TIMEOUT = 6 * 60 * 60  # seconds
+
+
+# Shape of the JSON Gemini returns, which is also the ai_content dict the
+# document builders read. The three ability levels share one task shape.
+class TaskContent(BaseModel):
+    activity: str
+    questions: list[str]
+    vak: str
+
+
+class LevelTasks(BaseModel):
+    assistance: TaskContent
+    average: TaskContent
+    upper: TaskContent
+
+
+class LevelOutcomes(BaseModel):
+    assistance: str
+    average: str
+    upper: str
+
+
+class QuestionActivity(BaseModel):
+    activity: str
+    questions: list[str]
+
+
+class TeachingComponent(BaseModel):
+    method: str
+    steps: list[str]
+
+
+class MoralEducation(BaseModel):
+    pillar: str
+    connection: str
+
+
+class SteamLinks(BaseModel):
+    science: str
+    technology: str
+    engineering: str
+    art: str
+    math: str
+
+
+class AdekIntegration(BaseModel):
+    my_identity: str
+    moral_education: MoralEducation
+    steam: SteamLinks
+    links_to_subjects: str
+    environment: str
+
+
+class LessonContent(BaseModel):
+    objectives: str
+    differentiated_outcomes: LevelOutcomes
+    vocabulary: list[str]
+    resources: list[str]
+    skills: list[str]
+    starter: QuestionActivity
+    teaching_component: TeachingComponent
+    cooperative_tasks: LevelTasks
+    independent_tasks: LevelTasks
+    plenary: QuestionActivity
+    world_application: str
+    adek_integration: AdekIntegration
+
+
+# lesson_data fields that decide the AI content. Anything else (date,
+# semester, PPT style...) only changes the documents, so it is left out of
+# the cache key and those requests still share one cached response. The
+# model tier (see _use_light_model) is added to the key as well.
+CACHE_KEY_FIELDS = ('grade', 'subject', 'topic', 'period', 'value')
+# Entries kept in memory per worker in front of the on-disk cache
+MEMORY_CACHE_SIZE = 256
+# Cached AI content older than this is regenerated so lessons do not go stale
+CACHE_TTL = 30 * 24 * 60 * 60  # seconds
+
+
+def _normalize_cache_value(value):
+    """Fold case, spacing and trailing punctuation so re-typed variants of the
+    same lesson ("Photosynthesis " / "photosynthesis.") share a cache entry"""
+    if value is None:
+        return ''
+    # Punctuation and the spaces around it go together, so "Photosynthesis ." matches too
+    return ' '.join(str(value).casefold().split()).strip('.,;:!? ')
+
+
+# Validator for each top-level ai_content section, so a single section from
+# Gemini can be checked before it replaces the template default. Content
+# with a missing or mis-shaped section (e.g. a starter without questions)
+# is rejected before a builder can fail half way through a package.
+SECTION_VALIDATORS = MappingProxyType({
+    name: TypeAdapter(field.annotation) for name, field in LessonContent.model_fields.items()
+})
+
+
+# Package members that are already compressed and gain nothing from DEFLATE
+PRECOMPRESSED_EXTENSIONS = ('.docx', '.pptx', '.zip', '.png', '.jpg', '.jpeg')
+
+
+# Fixed template content, built once instead of on every fallback call
+SUBJECT_VOCABULARY = MappingProxyType({
+    'Physics': ('Force', 'Energy', 'Motion', 'Velocity', 'Acceleration'),
+    'Chemistry': ('Atom', 'Molecule', 'Reaction', 'Compound', 'Element'),
+    'Biology': ('Cell', 'Organism', 'Ecosystem', 'Adaptation', 'Photosynthesis'),
+    'Science': ('Hypothesis', 'Variable', 'Observation', 'Evidence', 'Conclusion'),
+    'Mathematics': ('Equation', 'Variable', 'Function', 'Graph', 'Ratio'),
+    'English': ('Theme', 'Context', 'Inference', 'Argument', 'Evidence'),
+    'Computer Science': ('Algorithm', 'Variable', 'Loop', 'Function', 'Data'),
+    'Economics': ('Supply', 'Demand', 'Market', 'Scarcity', 'Opportunity Cost'),
+    'Business Studies': ('Enterprise', 'Profit', 'Revenue', 'Stakeholder', 'Market')
+})
+DEFAULT_VOCABULARY = ('Concept', 'Process', 'Evidence', 'Analysis', 'Application')
+DEFAULT_RESOURCES = ('Textbook and class notes', 'Interactive whiteboard', 'Worksheets', 'Hands-on materials')
+DEFAULT_SKILLS = ('Critical Thinking', 'Problem Solving', 'Collaboration', 'Communication', 'Digital Literacy')
+
+
+def _freeze(value):
+    """Read-only view of nested content: dicts become MappingProxyType and
+    lists become tuples, so a builder cannot change what the others see"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
 
 class LessonPlanGenerator:
+    # Gemini client shared across instances, see _get_client
+    _client = None
+    _client_lock = threading.Lock()
+    _generation_config = None
+    # Token bucket per model as [tokens, last refill time], see _wait_for_rate_limit
+    _rate_buckets = {}
+    _rate_lock = threading.Lock()
+    # Process pool for the PowerPoint builder, see _get_process_pool
+    _process_pool = None
+    _process_pool_lock = threading.Lock()
+    # Threads for the docx builders, shared by every request
+    _thread_pool = None
+    _thread_pool_lock = threading.Lock()
+    # Set once the output folders exist, so later instances skip the makedirs calls
+    _folders_ready = False
+    
     def __init__(self):
         self.output_folder = 'output'
         self.template_folder = 'documents'
-        os.makedirs(self.output_folder, exist_ok=True)
-        os.makedirs(self.template_folder, exist_ok=True)
+        self.cache_folder = os.path.join(self.output_folder, '.cache')
+        if not LessonPlanGenerator._folders_ready:
+            os.makedirs(self.output_folder, exist_ok=True)
+            os.makedirs(self.template_folder, exist_ok=True)
+            os.makedirs(self.cache_folder, exist_ok=True)
+            LessonPlanGenerator._folders_ready = True
+        # Recently used cache entries, so repeat requests skip the disk read
+        self._memory_cache = OrderedDict()
+        self._memory_cache_lock = threading.Lock()
         
-        # Initialize Gemini
-        api_key = os.getenv('GEMINI_API_KEY')
-        if not api_key:
-            print("WARNING: GEMINI_API_KEY not found. Using templates only.")
+        # Initialize Gemini (the client itself is created on first use)
+        if not os.getenv('GEMINI_API_KEY'):
+            logger.warning("GEMINI_API_KEY not found. Using templates only.")
             self.gemini = None
         else:
-            genai.configure(api_key=api_key)
-            # FIXED: Use correct model name
-            self.model = genai.GenerativeModel('gemini-1.5-flash-001')
             self.gemini = True
-            print("Gemini AI initialized with model: gemini-1.5-flash-001")
+    
+    @classmethod
+    def _get_client(cls):
+        """Gemini client, created once and shared by every instance"""
+        if cls._client is None:
+            with cls._client_lock:
+                if cls._client is None:
+                    # Imported here so template-only workers never load the Gemini SDK
+                    from google import genai
+                    from google.genai import types
+                    # Gemini answers with JSON matching LessonContent, so no text parsing is needed
+                    cls._generation_config = types.GenerateContentConfig(
+                        system_instruction=LESSON_PROMPT_INSTRUCTIONS,
+                        response_mime_type='application/json',
+                        response_schema=LessonContent,
+                        thinking_config=types.ThinkingConfig(thinking_budget=GEMINI_THINKING_BUDGET)
+                    )
+                    cls._client = genai.Client(api_key=os.environ['GEMINI_API_KEY'])
+                    logger.info("Gemini AI initialized with models: %s, %s", GEMINI_MODEL, GEMINI_LIGHT_MODEL)
+        return cls._client
+    
+    @classmethod
+    def _get_process_pool(cls):
+        """Worker process for the PowerPoint builder, started once and reused"""
+        if cls._process_pool is None:
+            with cls._process_pool_lock:
+                if cls._process_pool is None:
+                    # spawn, not fork: the parent has live threads and an open HTTP client
+                    cls._process_pool = ProcessPoolExecutor(
+                        max_workers=1,
+                        mp_context=multiprocessing.get_context('spawn')
+                    )
+        return cls._process_pool
+    
+    @classmethod
+    def _discard_process_pool(cls, pool):
+        """Drop a pool whose worker died, so the next call starts a fresh one"""
+        with cls._process_pool_lock:
+            if cls._process_pool is pool:
+                cls._process_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+    
+    def _submit_powerpoint(self, lesson_data, content):
+        """Queue the PowerPoint in the worker process, restarting it once if it
+        died; returns the pool with the future so a later failure can drop it"""
+        pool = self._get_process_pool()
+        try:
+            return pool, pool.submit(_build_powerpoint, lesson_data, content)
+        except BrokenProcessPool:
+            logger.warning("PowerPoint worker process died, starting a new one")
+            self._discard_process_pool(pool)
+            pool = self._get_process_pool()
+            return pool, pool.submit(_build_powerpoint, lesson_data, content)
+    
+    def _powerpoint_result(self, submitted, lesson_data, ai_content):
+        """Wait for the PowerPoint; if the worker died building it (e.g. OOM-killed),
+        drop its pool and build this one in the current thread instead"""
+        pool, future = submitted
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            logger.warning("PowerPoint worker process died, building in-process")
+            self._discard_process_pool(pool)
+            return self.create_powerpoint(lesson_data, ai_content)
+    
+    @classmethod
+    def _get_thread_pool(cls):
+        """Threads for the docx builders, started once and reused"""
+        if cls._thread_pool is None:
+            with cls._thread_pool_lock:
+                if cls._thread_pool is None:
+                    # Room for two requests' four docx builds at once
+                    cls._thread_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='docx')
+        return cls._thread_pool
     
     def generate_complete_package(self, lesson_data):
         """Generate complete lesson plan package"""
+        lesson_data = self._with_file_names(lesson_data)
         try:
-            print("Step 1: Generating AI content...")
+            logger.info("Step 1: Generating AI content for %s", lesson_data['topic'])
             if self.gemini:
-                ai_content = self.generate_ai_content_with_gemini(lesson_data)
+                content = self.generate_ai_content_with_gemini(lesson_data)
             else:
-                ai_content = self.generate_ai_content_with_templates(lesson_data)
-            
-            print("Step 2: Creating lesson plan document...")
-            lesson_doc = self.create_lesson_plan_document(lesson_data, ai_content)
-            
-            print("Step 3: Creating worksheets...")
-            worksheets = self.create_worksheets(lesson_data, ai_content)
-            
-            print("Step 4: Creating rubrics...")
-            rubrics = self.create_rubrics(lesson_data, ai_content)
-            
-            print("Step 5: Creating question bank...")
-            question_bank = self.create_question_bank(lesson_data, ai_content)
+                content = self.generate_ai_content_with_templates(lesson_data)
+            # The builders below share one read-only view of the content
+            ai_content = _freeze(content)
             
-            print("Step 6: Creating PowerPoint...")
-            ppt_file = self.create_powerpoint(lesson_data, ai_content)
+            # Steps 2-6 build independent files from the same ai_content,
+            # so they run side by side instead of one after another. The
+            # PowerPoint goes to a separate process so its python-pptx work
+            # does not compete with the docx threads for the GIL; it gets the
+            # plain dict because a frozen view cannot be pickled.
+            logger.info("Steps 2-6: Creating lesson plan, worksheets, rubrics, question bank and PowerPoint...")
+            powerpoint = self._submit_powerpoint(lesson_data, content)
+            executor = self._get_thread_pool()
+            futures = {
+                'lesson_plan': executor.submit(self.create_lesson_plan_document, lesson_data, ai_content),
+                'worksheets': executor.submit(self.create_worksheets, lesson_data, ai_content),
+                'rubrics': executor.submit(self.create_rubrics, lesson_data, ai_content),
+                'question_bank': executor.submit(self.create_question_bank, lesson_data, ai_content)
+            }
+            documents = {name: future.result() for name, future in futures.items()}
+            documents['powerpoint'] = self._powerpoint_result(powerpoint, lesson_data, ai_content)
             
-            print("Step 7: Packaging files...")
-            zip_file = self.package_files(lesson_data, [
-                lesson_doc, worksheets, rubrics, question_bank, ppt_file
-            ])
+            logger.info("Step 7: Packaging files...")
+            zip_file = self.package_files(lesson_data, list(documents.values()))
             
+            files = {name: os.path.basename(path) for name, path in documents.items()}
+            files['package'] = os.path.basename(zip_file)
             return {
                 'status': 'success',
-                'files': {
-                    'lesson_plan': os.path.basename(lesson_doc),
-                    'worksheets': os.path.basename(worksheets),
-                    'rubrics': os.path.basename(rubrics),
-                    'question_bank': os.path.basename(question_bank),
-                    'powerpoint': os.path.basename(ppt_file),
-                    'package': os.path.basename(zip_file)
-                },
-                'download_url': f'/api/download/{os.path.basename(zip_file)}'
+                'files': files,
+                'download_url': f"/api/download/{files['package']}"
             }
         
         except Exception as e:
-            print(f"Error: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("generate_complete_package failed")
             return {
                 'status': 'error',
                 'message': str(e)
@@ -84,102 +413,361 @@ class LessonPlanGenerator:
     
     def generate_ai_content_with_gemini(self, lesson_data):
         """Generate content using Google Gemini AI"""
-        print(f"Calling Gemini AI with key: {os.getenv('GEMINI_API_KEY')[:10]}...")
+        cache_file = self._cache_file(lesson_data)
+        # no_cache skips the lookup; the fresh result still replaces the cached one
+        if not lesson_data.get('no_cache'):
+            cached = self._read_cache(cache_file)
+            if cached is not None:
+                return self._merge_with_templates(lesson_data, cached)
         
-        # SIMPLE but EFFECTIVE prompt
-        prompt = f"""Create a detailed lesson plan for {lesson_data['grade']} grade {lesson_data['subject']} on topic: {lesson_data['topic']}
+        logger.info("Calling Gemini AI for %s", lesson_data['topic'])
         
-        School: Al Adhwa Private School, UAE
-        Period: {lesson_data['period']} (1=Introduction, 2=Development, 3=Mastery)
-        UAE Value: {lesson_data.get('value', 'Respect/Care')}
+        prompt = self._build_prompt(lesson_data)
+        content = None
+        try:
+            client = self._get_client()
+        except Exception as e:
+            logger.error("Gemini API error: %s", e)
+            client = None
         
-        Make it SPECIFIC with:
-        1. 3-4 clear objectives using Bloom's verbs (analyze, evaluate, create)
-        2. Differentiated activities for 3 ability levels
-        3. UAE context and values integration
-        4. SPECIFIC questions for each activity (not general)
-        5. Real-world applications in UAE context
+        # Try the light model first where it is good enough, then the full model.
+        # Each model gets its own try so a light-model failure still reaches the full one.
+        models = [GEMINI_MODEL] if client is not None else []
+        if models and self._use_light_model(lesson_data):
+            models.insert(0, GEMINI_LIGHT_MODEL)
         
-        Example format for objectives:
-        "Students will be able to ANALYZE the relationship between variables through data collection."
-        "Students will be able to EVALUATE different solutions by comparing effectiveness."
+        for model in models:
+            try:
+                response = self._call_gemini(client, model, prompt)
+                text = response.text
+                
+                logger.info("Gemini response received from %s (%d chars)", model, len(text))
+                logger.debug("First 500 chars: %s", text[:500])
+                usage = getattr(response, 'usage_metadata', None)
+                if usage is not None:
+                    logger.debug("Prompt tokens: %s", usage.prompt_token_count)
+                
+                # Parse the response
+                content = self.parse_gemini_response(text)
+            except Exception as e:
+                logger.error("Gemini API error from %s: %s", model, e)
+                continue
+            if self._is_complete_content(content):
+                break
         
-        Example for activities:
-        "Group 1: Create a model showing X and answer: 1. What are the main components? 2. How do they interact? 3. What would happen if Y changed?"
+        # Only a complete Gemini answer is cached, never a partial one or the
+        # template fallback, so a failed call is retried on the next request.
+        # The template defaults depend on fields outside the cache key and are
+        # rebuilt for every request.
+        if self._is_complete_content(content):
+            self._write_cache(cache_file, content)
+        return self._merge_with_templates(lesson_data, content)
+    
+    def generate_ai_content_batch(self, lesson_data_list, timeout=GEMINI_BATCH_TIMEOUT):
+        """Generate content for many lessons with one Gemini batch job.
         
-        Be PRACTICAL for classroom use in UAE schools."""
+        Batch jobs cost half as much per request but can take minutes to
+        hours, so this is for bulk imports, not the interactive endpoint.
+        The job is cancelled after timeout seconds. Returns one read-only
+        content view per lesson, in order (sections may be shared with the
+        cache); cached lessons are not resubmitted and failed ones fall back
+        to templates.
+        """
+        # Gemini's content per lesson, from the cache or the batch job
+        contents = [None] * len(lesson_data_list)
+        pending = []
+        for index, lesson_data in enumerate(lesson_data_list):
+            if not lesson_data.get('no_cache'):
+                contents[index] = self._read_cache(self._cache_file(lesson_data))
+            if contents[index] is None:
+                pending.append(index)
         
-        try:
-            response = self.model.generate_content(prompt)
-            text = response.text
+        if pending:
+            logger.info("Submitting Gemini batch of %d lessons", len(pending))
+            try:
+                texts = self._run_batch([lesson_data_list[index] for index in pending], timeout)
+            except Exception as e:
+                logger.error("Gemini batch error: %s", e)
+                texts = [None] * len(pending)
             
-            print(f"Gemini response received ({len(text)} chars)")
-            print(f"First 500 chars: {text[:500]}")
-            
-            # Parse the response
-            return self.parse_gemini_response(text, lesson_data)
-            
-        except Exception as e:
-            print(f"Gemini API error: {e}")
-            return self.generate_ai_content_with_templates(lesson_data)
+            for index, text in zip(pending, texts):
+                content = self.parse_gemini_response(text) if text else None
+                if self._is_complete_content(content):
+                    self._write_cache(self._cache_file(lesson_data_list[index]), content)
+                contents[index] = content
+        
+        return [
+            _freeze(self._merge_with_templates(lesson_data, content))
+            for lesson_data, content in zip(lesson_data_list, contents)
+        ]
     
-    def parse_gemini_response(self, text, lesson_data):
-        """Parse Gemini's text response into structured content"""
-        print("Parsing Gemini response...")
+    def _run_batch(self, lesson_data_list, timeout):
+        """Run one inline Gemini batch job; response text per lesson, None where it failed"""
+        client = self._get_client()
+        job = client.batches.create(
+            model=GEMINI_MODEL,
+            src=[{
+                'contents': [{'role': 'user', 'parts': [{'text': self._build_prompt(lesson_data)}]}],
+                'config': self._generation_config
+            } for lesson_data in lesson_data_list]
+        )
         
-        # For now, use a simple approach: extract key sections
-        # In production, you'd want better parsing
-        lines = text.split('\n')
+        deadline = time.monotonic() + timeout
+        while job.state.name not in GEMINI_BATCH_DONE_STATES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # Cancel so the job does not keep running for results nobody reads
+                client.batches.cancel(name=job.name)
+                raise TimeoutError(f"batch job {job.name} still {job.state.name} after {timeout}s")
+            time.sleep(min(GEMINI_BATCH_POLL_INTERVAL, remaining))
+            job = client.batches.get(name=job.name)
+        if job.state.name != 'JOB_STATE_SUCCEEDED':
+            raise RuntimeError(f"batch job {job.name} ended in {job.state.name}")
         
-        # Extract objectives
-        objectives = []
-        for line in lines:
-            if any(word in line.lower() for word in ['students will', 'objective', 'will be able to']):
-                if line.strip() and len(line) > 20:
-                    objectives.append(line.strip())
-                    if len(objectives) >= 3:
-                        break
+        return [
+            item.response.text if item.response is not None else None
+            for item in job.dest.inlined_responses
+        ]
+    
+    def _build_prompt(self, lesson_data):
+        """Per-lesson prompt; the instructions travel as the system instruction"""
+        return LESSON_PROMPT_DETAILS.format(
+            grade=lesson_data['grade'],
+            subject=lesson_data['subject'],
+            topic=lesson_data['topic'],
+            period=lesson_data['period'],
+            value=lesson_data.get('value', 'Respect/Care')
+        )
+    
+    def _merge_with_templates(self, lesson_data, content):
+        """Template content with every non-empty section Gemini returned laid over it"""
+        defaults = self.generate_ai_content_with_templates(lesson_data)
+        if not isinstance(content, dict):
+            logger.warning("No structured Gemini content, using templates")
+            return defaults
         
-        # If Gemini gave good content, use it
-        if objectives and len(objectives) >= 2:
-            print("Using Gemini-generated content")
-            return self.create_content_from_gemini(text, lesson_data)
-        else:
-            print("Gemini response not structured, using templates")
-            return self.generate_ai_content_with_templates(lesson_data)
+        # Sections are replaced whole, so each one must match the schema on its own
+        defaults.update({
+            key: value for key, value in content.items()
+            if key in defaults and value and self._is_valid_section(key, value)
+        })
+        return defaults
+    
+    def _call_gemini(self, client, model, prompt):
+        """Call Gemini, retrying transient errors with jittered exponential backoff"""
+        for attempt in range(1, GEMINI_MAX_ATTEMPTS + 1):
+            self._wait_for_rate_limit(model)
+            try:
+                return client.models.generate_content(
+                    model=model,
+                    contents=prompt,
+                    config=self._generation_config
+                )
+            except Exception as e:
+                if attempt == GEMINI_MAX_ATTEMPTS or not self._is_retryable(e):
+                    raise
+                delay = random.uniform(0, min(GEMINI_MAX_BACKOFF, 2 ** attempt))
+                logger.warning("Gemini call failed (%s), retry %d in %.1fs", e, attempt, delay)
+                time.sleep(delay)
+    
+    @classmethod
+    def _wait_for_rate_limit(cls, model):
+        """Take a token from the model's bucket, waiting for one to refill if it is empty"""
+        if GEMINI_RPM_LIMIT <= 0:
+            return
+        refill_rate = GEMINI_RPM_LIMIT / 60  # tokens per second
+        with cls._rate_lock:
+            now = time.monotonic()
+            bucket = cls._rate_buckets.setdefault(model, [GEMINI_RPM_LIMIT, now])
+            bucket[0] = min(GEMINI_RPM_LIMIT, bucket[0] + (now - bucket[1]) * refill_rate)
+            bucket[1] = now
+            # Take the token even when it is not there yet; a negative balance
+            # queues later callers behind this one
+            bucket[0] -= 1
+            delay = -bucket[0] / refill_rate if bucket[0] < 0 else 0
+        if delay:
+            logger.info("Gemini rate limit for %s, waiting %.1fs", model, delay)
+            time.sleep(delay)
+    
+    def _is_retryable(self, error):
+        """Rate limits (429) and server-side (5xx) errors are worth retrying"""
+        from google.genai import errors
+        return isinstance(error, errors.ServerError) or (
+            isinstance(error, errors.ClientError) and error.code == 429
+        )
+    
+    def _is_complete_content(self, content):
+        """Check that content matches LessonContent, down to the nested fields the builders read"""
+        if not isinstance(content, dict):
+            return False
+        try:
+            LessonContent.model_validate(content)
+        except ValidationError as e:
+            logger.debug("AI content does not match the schema: %s", e)
+            return False
+        return True
+    
+    def _is_valid_section(self, key, value):
+        """Check one ai_content section against its LessonContent field"""
+        try:
+            SECTION_VALIDATORS[key].validate_python(value)
+        except ValidationError:
+            logger.warning("Ignoring malformed Gemini section %r", key)
+            return False
+        return True
+    
+    def _use_light_model(self, lesson_data):
+        """Introductory lessons without G&T extension work go to the light model"""
+        return str(lesson_data['period']) == '1' and not lesson_data.get('gifted_talented')
+    
+    def _cache_file(self, lesson_data):
+        """Path of the cached AI content for this lesson"""
+        key_fields = {field: _normalize_cache_value(lesson_data.get(field)) for field in CACHE_KEY_FIELDS}
+        # Light-model answers must not be served to lessons that need the full model
+        key_fields['light_model'] = self._use_light_model(lesson_data)
+        key = hashlib.blake2b(_json_dumps_sorted(key_fields), digest_size=16).hexdigest()
+        return os.path.join(self.cache_folder, f"{key}.json")
     
-    def create_content_from_gemini(self, text, lesson_data):
-        """Create structured content from Gemini's response"""
-        # Use Gemini's text but structure it properly
+    def _read_cache(self, cache_file):
+        """Cached AI content from memory, then disk; None on a miss"""
+        with self._memory_cache_lock:
+            if cache_file in self._memory_cache:
+                stored_at, cached = self._memory_cache[cache_file]
+                if time.time() - stored_at < CACHE_TTL:
+                    self._memory_cache.move_to_end(cache_file)
+                    logger.info("Using in-memory AI content: %s", os.path.basename(cache_file))
+                    return cached
+                del self._memory_cache[cache_file]
+        
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            stored_at = os.path.getmtime(cache_file)
+            if time.time() - stored_at >= CACHE_TTL:
+                logger.info("Cached AI content expired, regenerating")
+                return None
+            with open(cache_file, 'rb') as f:
+                cached = _json_loads(f.read())
+        except (OSError, ValueError) as e:  # JSON decode errors are ValueErrors
+            logger.warning("Cached AI content is unreadable, regenerating: %s", e)
+            return None
+        if not self._is_complete_content(cached):
+            logger.warning("Cached AI content is incomplete, regenerating")
+            return None
+        
+        logger.info("Using cached AI content: %s", os.path.basename(cache_file))
+        self._remember(cache_file, cached, stored_at)
+        return cached
+    
+    def _remember(self, cache_file, content, stored_at=None):
+        """Keep content in the in-process LRU, evicting the oldest entry when full"""
+        if stored_at is None:
+            stored_at = time.time()
+        with self._memory_cache_lock:
+            self._memory_cache[cache_file] = (stored_at, content)
+            self._memory_cache.move_to_end(cache_file)
+            if len(self._memory_cache) > MEMORY_CACHE_SIZE:
+                self._memory_cache.popitem(last=False)
+    
+    def _write_cache(self, cache_file, content):
+        """Write cached AI content atomically so readers never see a partial file"""
+        self._remember(cache_file, content)
+        tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(_json_dumps(content))
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            logger.warning("Could not write AI content cache: %s", e)
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+    
+    def parse_gemini_response(self, text):
+        """Parse Gemini's JSON response into structured content.
+        
+        Returns None when the response is not valid JSON.
+        """
+        try:
+            return _json_loads(text)
+        except json.JSONDecodeError as e:  # orjson's error subclasses this too
+            logger.warning("Gemini response is not valid JSON: %s", e)
+            return None
+    
+    # KEEP ALL YOUR EXISTING TEMPLATE FUNCTIONS
+    def generate_ai_content_with_templates(self, lesson_data):
+        """Fallback: Use templates"""
+        content = {
+            'objectives': self._generate_objectives(lesson_data),
+            'differentiated_outcomes': self._generate_outcomes(lesson_data),
+            'vocabulary': self._generate_vocabulary(lesson_data),
+            'resources': self._generate_resources(lesson_data),
+            'skills': self._generate_skills(lesson_data),
+            'starter': self._generate_starter(lesson_data),
+            'teaching_component': self._generate_teaching(lesson_data),
+            'cooperative_tasks': self._generate_differentiated_tasks(lesson_data, 'cooperative'),
+            'independent_tasks': self._generate_differentiated_tasks(lesson_data, 'independent'),
+            'plenary': self._generate_plenary(lesson_data),
+            'world_application': self._generate_world_application(lesson_data),
+            'adek_integration': self._generate_adek_integration(lesson_data)
+        }
+        
+        return content
+    
+    # Template helpers. Each returns one ai_content section; Gemini output
+    # overrides them section by section in generate_ai_content_with_gemini.
+    def _generate_objectives(self, lesson_data):
+        topic = lesson_data['topic']
+        return "\n".join([
+            f"Students will be able to IDENTIFY and DESCRIBE the key ideas of {topic}.",
+            f"Students will be able to ANALYZE how the parts of {topic} relate to each other.",
+            f"Students will be able to EVALUATE real-world applications of {topic} in the UAE context."
+        ])
+    
+    def _generate_outcomes(self, lesson_data):
         return {
-            'objectives': f"Based on Gemini AI: {text[:200]}...",
-            'differentiated_outcomes': {
-                'assistance': "Identify and describe key concepts with support (DOK 1-2)",
-                'average': "Apply concepts to solve problems independently (DOK 2-3)", 
-                'upper': "Evaluate evidence and create innovative solutions (DOK 3-4)"
-            },
-            'vocabulary': ['Term from AI', 'Another term', 'Key concept'],
-            'resources': ['AI-suggested resources', 'Digital tools', 'Hands-on materials'],
-            'skills': ["Critical Thinking", "Problem Solving", "Collaboration", "Communication", "Digital Literacy"],
-            'starter': {
-                'activity': f"AI-suggested starter for {lesson_data['topic']}",
-                'questions': [
-                    "What connections can you make?",
-                    "What questions does this raise?",
-                    "How might this apply in UAE context?"
-                ]
-            },
-            'teaching_component': {
-                'method': "Interactive AI-enhanced teaching",
-                'steps': [
-                    "Introduce concepts with real examples",
-                    "Demonstrate key principles", 
-                    "Guide hands-on practice",
-                    "Facilitate discussion",
-                    "Check understanding"
-                ]
-            },
-            'cooperative_tasks': {
+            'assistance': "Identify and describe key concepts with support (DOK 1-2)",
+            'average': "Apply concepts to solve problems independently (DOK 2-3)",
+            'upper': "Evaluate evidence and create innovative solutions (DOK 3-4)"
+        }
+    
+    def _generate_vocabulary(self, lesson_data):
+        return SUBJECT_VOCABULARY.get(lesson_data['subject'], DEFAULT_VOCABULARY)
+    
+    def _generate_resources(self, lesson_data):
+        if lesson_data.get('digital_platform'):
+            return DEFAULT_RESOURCES + (lesson_data['digital_platform'],)
+        return DEFAULT_RESOURCES
+    
+    def _generate_skills(self, lesson_data):
+        return DEFAULT_SKILLS
+    
+    def _generate_starter(self, lesson_data):
+        return {
+            'activity': f"Think-pair-share: what do you already know about {lesson_data['topic']}?",
+            'questions': [
+                "What connections can you make?",
+                "What questions does this raise?",
+                "How might this apply in UAE context?"
+            ]
+        }
+    
+    def _generate_teaching(self, lesson_data):
+        return {
+            'method': f"{lesson_data.get('ppt_style') or 'Interactive'} direct instruction with guided practice",
+            'steps': [
+                "Introduce concepts with real examples",
+                "Demonstrate key principles",
+                "Guide hands-on practice",
+                "Facilitate discussion",
+                "Check understanding"
+            ]
+        }
+    
+    def _generate_differentiated_tasks(self, lesson_data, task_type):
+        if task_type == 'cooperative':
+            return {
                 'assistance': {
                     'activity': "Collaborative basic task",
                     'questions': ["What are the key elements?", "How do they work together?", "Give an example."],
@@ -195,81 +783,94 @@ class LessonPlanGenerator:
                     'questions': ["Design a solution for...", "Evaluate different approaches...", "Justify your conclusions..."],
                     'vak': 'Visual: models; Auditory: presentation; Kinesthetic: construction'
                 }
+            }
+        return {
+            'assistance': {
+                'activity': "Guided independent work",
+                'questions': ["Identify the main idea...", "Describe the process...", "Apply to simple case..."],
+                'vak': 'Visual: worksheets; Auditory: self-talk; Kinesthetic: manipulation'
             },
-            'independent_tasks': {
-                'assistance': {
-                    'activity': "Guided independent work",
-                    'questions': ["Identify the main idea...", "Describe the process...", "Apply to simple case..."],
-                    'vak': 'Visual: worksheets; Auditory: self-talk; Kinesthetic: manipulation'
-                },
-                'average': {
-                    'activity': "Independent analysis",
-                    'questions': ["Analyze the data...", "Compare different methods...", "Solve the problem..."],
-                    'vak': 'Visual: graphs; Auditory: recording; Kinesthetic: measurement'
-                },
-                'upper': {
-                    'activity': "Advanced independent research",
-                    'questions': ["Research and evaluate...", "Create an original...", "Defend your approach..."],
-                    'vak': 'Visual: research papers; Auditory: self-explanation; Kinesthetic: prototyping'
-                }
-            },
-            'plenary': {
-                'activity': "AI-enhanced review session",
-                'questions': [
-                    "What was most insightful?",
-                    "How does this connect to UAE Vision?",
-                    "What would you explore next?"
-                ]
+            'average': {
+                'activity': "Independent analysis",
+                'questions': ["Analyze the data...", "Compare different methods...", "Solve the problem..."],
+                'vak': 'Visual: graphs; Auditory: recording; Kinesthetic: measurement'
             },
-            'world_application': f"AI insights on {lesson_data['topic']} applications in UAE's smart cities, renewable energy, and technological innovation.",
-            'adek_integration': {
-                'my_identity': f"Connecting {lesson_data['topic']} to UAE's national identity and innovation goals.",
-                'moral_education': {
-                    'pillar': 'Character and Morality',
-                    'connection': 'Developing ethical reasoning and responsible application of knowledge.'
-                },
-                'steam': {
-                    'science': 'Scientific investigation',
-                    'technology': 'Digital innovation',
-                    'engineering': 'Design thinking',
-                    'art': 'Creative expression',
-                    'math': 'Quantitative analysis'
-                },
-                'links_to_subjects': "Mathematics, ICT, English, UAE Studies",
-                'environment': "Sustainability applications and environmental stewardship."
+            'upper': {
+                'activity': "Advanced independent research",
+                'questions': ["Research and evaluate...", "Create an original...", "Defend your approach..."],
+                'vak': 'Visual: research papers; Auditory: self-explanation; Kinesthetic: prototyping'
             }
         }
     
-    # KEEP ALL YOUR EXISTING TEMPLATE FUNCTIONS
-    def generate_ai_content_with_templates(self, lesson_data):
-        """Fallback: Use templates"""
-        period_descriptions = {
-            1: "introductory/foundational level",
-            2: "intermediate/development level",
-            3: "advanced/mastery level"
+    def _generate_plenary(self, lesson_data):
+        return {
+            'activity': f"Exit ticket and class review of {lesson_data['topic']}",
+            'questions': [
+                "What was most insightful?",
+                "How does this connect to UAE Vision?",
+                "What would you explore next?"
+            ]
         }
-        
-        period_desc = period_descriptions.get(int(lesson_data['period']), period_descriptions[1])
-        
-        content = {
-            'objectives': self._generate_objectives(lesson_data),
-            'differentiated_outcomes': self._generate_outcomes(lesson_data),
-            'vocabulary': self._generate_vocabulary(lesson_data),
-            'resources': self._generate_resources(lesson_data),
-            'skills': self._generate_skills(lesson_data),
-            'starter': self._generate_starter(lesson_data),
-            'teaching_component': self._generate_teaching(lesson_data),
-            'cooperative_tasks': self._generate_differentiated_tasks(lesson_data, 'cooperative'),
-            'independent_tasks': self._generate_differentiated_tasks(lesson_data, 'independent'),
-            'plenary': self._generate_plenary(lesson_data),
-            'world_application': self._generate_world_application(lesson_data),
-            'adek_integration': self._generate_adek_integration(lesson_data)
+    
+    def _generate_world_application(self, lesson_data):
+        return f"Applications of {lesson_data['topic']} in UAE's smart cities, renewable energy, and technological innovation."
+    
+    def _generate_adek_integration(self, lesson_data):
+        return {
+            'my_identity': f"Connecting {lesson_data['topic']} to UAE's national identity and innovation goals.",
+            'moral_education': {
+                'pillar': 'Character and Morality',
+                'connection': 'Developing ethical reasoning and responsible application of knowledge.'
+            },
+            'steam': {
+                'science': 'Scientific investigation',
+                'technology': 'Digital innovation',
+                'engineering': 'Design thinking',
+                'art': 'Creative expression',
+                'math': 'Quantitative analysis'
+            },
+            'links_to_subjects': "Mathematics, ICT, English, UAE Studies",
+            'environment': "Sustainability applications and environmental stewardship."
         }
-        
-        return content
     
-    # COPY ALL YOUR EXISTING TEMPLATE HELPER FUNCTIONS HERE
-    # _generate_objectives, _generate_outcomes, etc.
     # COPY ALL YOUR EXISTING DOCUMENT CREATION FUNCTIONS HERE
     # create_lesson_plan_document, create_worksheets, etc.
 
+    
+    def _with_file_names(self, lesson_data):
+        """Copy of lesson_data carrying one timestamp and filename-safe topic,
+        so every file in a package is named from the same values"""
+        if '_timestamp' in lesson_data:
+            return lesson_data
+        return dict(
+            lesson_data,
+            _timestamp=datetime.now().strftime('%Y%m%d_%H%M%S'),
+            _safe_topic=lesson_data['topic'].replace(' ', '_').replace('/', '-')
+        )
+    
+    def package_files(self, lesson_data, file_paths):
+        """Bundle the generated documents into one downloadable ZIP"""
+        lesson_data = self._with_file_names(lesson_data)
+        zip_path = os.path.join(
+            self.output_folder,
+            f"{lesson_data['_safe_topic']}_Lesson_Package_{lesson_data['_timestamp']}.zip"
+        )
+        
+        # .docx/.pptx files are already deflated ZIP containers, so they are
+        # stored as-is instead of being compressed a second time. Anything
+        # else gets the fastest DEFLATE level; the members are small.
+        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
+            for file_path in file_paths:
+                if file_path:
+                    if file_path.lower().endswith(PRECOMPRESSED_EXTENSIONS):
+                        compress_type = zipfile.ZIP_STORED
+                    else:
+                        compress_type = zipfile.ZIP_DEFLATED
+                    zipf.write(file_path, os.path.basename(file_path), compress_type=compress_type)
+        
+        return zip_path
+
+
+def _build_powerpoint(lesson_data, ai_content):
+    """Process-pool entry point for create_powerpoint (must be module level to pickle)"""
+    return LessonPlanGenerator().create_powerpoint(lesson_data, _freeze(ai_content))